@@ -1,11 +1,20 @@
 # backend/main.py
 
+import io
+import os
 import uuid
 import json
+import gzip
+import asyncio
+import hashlib
+import shutil
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Literal
+from typing import Dict, Iterator, List, Literal, Optional, Tuple
 
 import fitz  # PyMuPDF
+import numpy as np
+import orjson
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -14,22 +23,42 @@ from pydantic import BaseModel
 from ultralytics import YOLO
 
 from reportlab.lib.colors import HexColor
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase import pdfmetrics
 from pypdf import PdfReader, PdfWriter
 
+from armeta_backend.pdf_render import get_render_pool, render_page
+
 # -------------------------------------------------------
 # Конфиг путей
 # -------------------------------------------------------
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 RUNTIME_DIR = PROJECT_ROOT / "runtime_data"  # сюда сохраняем страницы
 RUNTIME_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_INDEX_PATH = RUNTIME_DIR / ".cache_index.json"  # хэш содержимого файла -> doc_id
+RESULT_NAME = "result.json.gz"  # DocResult: orjson + gzip
+LEGACY_RESULT_NAME = "result.json"  # так DocResult хранился раньше (обычный JSON)
+UPLOAD_CHUNK = 1 << 20  # загрузки читаем окнами по 1 МБ, а не целиком в память
 BACKEND_BASE = "http://127.0.0.1:8000"
 
 MODEL_PATH = PROJECT_ROOT / "models" / "best_yolo_raw.pt"
+YOLO_BATCH = 16  # сколько страниц отдаём в model.predict за один вызов
+# TensorRT FP16, собирается при первом старте. Максимальный батч зашит в движок,
+# поэтому в имени — YOLO_BATCH: движок CLI-скрипта (другой батч) сюда не попадёт
+ENGINE_PATH = MODEL_PATH.with_name(f"{MODEL_PATH.stem}.b{YOLO_BATCH}.engine")
+# метка «экспорт в TensorRT здесь не работает»: пока она новее .pt, не пробуем снова
+NO_ENGINE_MARKER = ENGINE_PATH.with_suffix(".no_engine")
+# 200 DPI: A4 ≈ 1654×2339, всё ещё больше входа YOLO (1024), но вдвое меньше пикселей, чем 300 DPI
+RENDER_DPI = int(os.getenv("RENDER_DPI", "200"))
+YOLO_CONF = 0.25  # порог уверенности детекций
+ANALYZE_CONCURRENCY = int(os.getenv("ANALYZE_CONCURRENCY", "4"))  # документов одновременно
+SOURCE_CACHE_BYTES = 256 << 20  # сколько исходных PDF (в байтах) держим в кэше отчётов
 
 LOGO_PATH = PROJECT_ROOT / "assets" / "favicon.png"
+# декодируем логотип один раз, а не на каждый отчёт
+LOGO_IMAGE = ImageReader(str(LOGO_PATH)) if LOGO_PATH.exists() else None
 STATIC_URL = "/static"  # URL-префикс для картинок
 
 FONT_DIR = PROJECT_ROOT / "assets" / "fonts"
@@ -45,6 +74,9 @@ ID2LABEL = {
     2: "qr",
 }
 LABEL_TYPE = Literal["signature", "stamp", "qr"]
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp"}  # одна картинка = одна страница
+# допустимые id классов для np.isin — собираем один раз, а не на каждую страницу
+_VALID_IDS = np.fromiter(ID2LABEL, dtype=np.int64)
 
 
 # -------------------------------------------------------
@@ -96,108 +128,363 @@ app.mount(
     name="static",
 )
 
+def load_model() -> YOLO:
+    """
+    Загрузить YOLO в самом быстром доступном бэкенде.
+
+    Если .engine нет или он старше .pt (модель переобучили) — экспортируем
+    .pt в TensorRT FP16 заново; если лежит только .engine — берём его как есть.
+    Если TensorRT/CUDA недоступны — остаёмся на PyTorch и запоминаем это
+    в NO_ENGINE_MARKER, чтобы не повторять экспорт на каждом старте
+    (до замены .pt).
+    """
+    model_mtime = MODEL_PATH.stat().st_mtime if MODEL_PATH.exists() else None
+    if ENGINE_PATH.exists() and (
+        model_mtime is None or ENGINE_PATH.stat().st_mtime >= model_mtime
+    ):
+        return YOLO(str(ENGINE_PATH), task="detect")
+
+    # без .pt экспортировать нечего (YOLO сам сообщит, что файла нет)
+    if model_mtime is None:
+        return YOLO(str(MODEL_PATH), task="detect")
+    if NO_ENGINE_MARKER.exists() and NO_ENGINE_MARKER.stat().st_mtime >= model_mtime:
+        print(f"[API] TensorRT export failed before (see {NO_ENGINE_MARKER}), using PyTorch model")
+        return YOLO(str(MODEL_PATH), task="detect")
+
+    print(f"[API] Exporting {MODEL_PATH.name} to TensorRT FP16...")
+    try:
+        exported = YOLO(str(MODEL_PATH)).export(
+            format="engine",
+            half=True,
+            imgsz=1024,
+            batch=YOLO_BATCH,
+            dynamic=True,
+            workspace=4,
+        )
+        # Ultralytics всегда пишет <stem>.engine — переименовываем в свой файл
+        Path(exported).replace(ENGINE_PATH)
+    except Exception as e:
+        print(f"[API] TensorRT export failed ({e}), using PyTorch model")
+        NO_ENGINE_MARKER.write_text(f"{e}\n", encoding="utf-8")
+        return YOLO(str(MODEL_PATH), task="detect")
+
+    NO_ENGINE_MARKER.unlink(missing_ok=True)
+    return YOLO(str(ENGINE_PATH), task="detect")
+
+
+def warmup_model(m: YOLO) -> None:
+    """
+    Прогнать модель на пустой картинке 1024×1024, чтобы инициализация CUDA,
+    cuDNN и TensorRT-контекста не попадала в первый пользовательский запрос.
+    Первый прогон собирает ядра, второй проходит уже по закэшированному пути.
+    """
+    dummy = np.zeros((1024, 1024, 3), np.uint8)
+    try:
+        for _ in range(2):
+            m.predict(source=dummy, imgsz=1024, conf=0.25, verbose=False)
+    except Exception as e:
+        print(f"[API] Warm-up failed ({e}), continuing without it")
+
+
+def model_fingerprint() -> str:
+    """
+    Отпечаток всего, от чего зависит результат анализа: файлы весов
+    (.pt и .engine — имя, размер, mtime), RENDER_DPI и YOLO_CONF.
+    Входит в ключ кэша, так что после замены модели или смены настроек
+    старые результаты не отдаются.
+    """
+    parts = [f"dpi={RENDER_DPI}", f"conf={YOLO_CONF}"]
+    for path in (MODEL_PATH, ENGINE_PATH):
+        if path.exists():
+            st = path.stat()
+            parts.append(f"{path.name}:{st.st_size}:{st.st_mtime_ns}")
+    return "|".join(parts)
+
+
 # Загружаем модель один раз при старте процесса
 print(f"[API] Loading YOLO model from: {MODEL_PATH}")
-model = YOLO(str(MODEL_PATH))
+model = load_model()
+warmup_model(model)
+MODEL_FINGERPRINT = model_fingerprint()  # после load_model: экспорт мог создать .engine
 print("[API] Model loaded")
 
+# Тяжёлая работа идёт в потоках (asyncio.to_thread), чтобы не блокировать event loop.
+# _ANALYZE_SEM ограничивает число документов в обработке, а _MODEL_LOCK
+# сериализует model.predict — один predictor Ultralytics не потокобезопасен.
+# Так рендер PDF одного запроса перекрывается с инференсом другого.
+_ANALYZE_SEM = asyncio.Semaphore(ANALYZE_CONCURRENCY)
+_MODEL_LOCK = asyncio.Lock()
+_CACHE_LOCK = asyncio.Lock()  # защищает read-modify-write индекса кэша
+
 
 # -------------------------------------------------------
 # Вспомогательные функции
 # -------------------------------------------------------
+def upload_digest(upload: UploadFile) -> str:
+    """
+    Ключ кэша: хэш содержимого загруженного файла вместе с MODEL_FINGERPRINT
+    (указатель файла возвращается в начало).
+    """
+    h = hashlib.blake2b(MODEL_FINGERPRINT.encode(), digest_size=16)
+    while chunk := upload.file.read(UPLOAD_CHUNK):
+        h.update(chunk)
+    upload.file.seek(0)
+    return h.hexdigest()
+
+
+def save_doc_result(path: Path, doc: DocResult) -> None:
+    """Сохранить DocResult компактно: orjson без отступов + быстрый gzip."""
+    payload = orjson.dumps(doc.model_dump())
+    path.write_bytes(gzip.compress(payload, compresslevel=1))
+
+
+def load_doc_result(path: Path) -> DocResult:
+    data = path.read_bytes()
+    if path.suffix == ".gz":
+        data = gzip.decompress(data)
+    return DocResult.model_validate(orjson.loads(data))
+
+
+def doc_result_path(doc_dir: Path) -> Optional[Path]:
+    """
+    Файл с DocResult документа: result.json.gz, а для папок, записанных
+    до перехода на gzip, — старый result.json. None, если нет ни того, ни другого.
+    """
+    for name in (RESULT_NAME, LEGACY_RESULT_NAME):
+        path = doc_dir / name
+        if path.exists():
+            return path
+    return None
+
+
+def _load_cache_index() -> Dict[str, str]:
+    if not CACHE_INDEX_PATH.exists():
+        return {}
+    try:
+        return json.loads(CACHE_INDEX_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache_index(index: Dict[str, str]) -> None:
+    """Записать индекс кэша атомарно (через временный файл)."""
+    tmp_path = CACHE_INDEX_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(index), encoding="utf-8")
+    tmp_path.replace(CACHE_INDEX_PATH)
+
+
+def cached_result(digest: str) -> Optional[DocResult]:
+    """
+    Сохранённый DocResult для уже анализированного файла с тем же содержимым.
+    Запись, чья папка документа уже удалена, выбрасывается из индекса.
+    """
+    index = _load_cache_index()
+    doc_id = index.get(digest)
+    if doc_id is None:
+        return None
+    result_path = doc_result_path(RUNTIME_DIR / doc_id)
+    if result_path is None:
+        del index[digest]
+        _write_cache_index(index)
+        return None
+    return load_doc_result(result_path)
+
+
+def remember_result(digest: str, doc_id: str) -> None:
+    """Записать digest -> doc_id в индекс кэша."""
+    index = _load_cache_index()
+    index[digest] = doc_id
+    _write_cache_index(index)
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    """
+    Hard link, если можно, иначе копия. Файлы документа пишутся один раз
+    в новую папку и больше не перезаписываются, так что общий inode безопасен.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def reuse_result(cached: DocResult, filename: str) -> DocResult:
+    """
+    Новый документ для повторной загрузки того же файла, без YOLO:
+    свой doc_id и свой result с именем файла из этой загрузки (его берёт
+    /report), URL страниц — от текущего BACKEND_BASE. Детекции — из cached,
+    страницы и исходный PDF — ссылки на файлы исходного документа.
+    """
+    doc_id = str(uuid.uuid4())
+    src_dir = RUNTIME_DIR / cached.id
+    doc_dir = RUNTIME_DIR / doc_id
+    pages_dir = doc_dir / "pages"
+    pages_dir.mkdir(parents=True)
+
+    if (src_dir / "source.pdf").exists():
+        _link_or_copy(src_dir / "source.pdf", doc_dir / "source.pdf")
+
+    pages: List[PageResult] = []
+    for page in cached.pages:
+        name = Path(page.imageUrl).name
+        _link_or_copy(src_dir / "pages" / name, pages_dir / name)
+        pages.append(page.model_copy(update={"imageUrl": page_url(pages_dir / name)}))
+
+    doc = DocResult(id=doc_id, filename=filename, pages=pages)
+    save_doc_result(doc_dir / RESULT_NAME, doc)
+    return doc
+
+
+def page_url(page_path: Path) -> str:
+    """URL страницы для фронта: /static/<doc_id>/pages/page_001.jpg"""
+    rel_path = page_path.relative_to(RUNTIME_DIR).as_posix()
+    return f"{BACKEND_BASE}{STATIC_URL}/{rel_path}"
+
+
 def save_upload_to_temp(upload: UploadFile, dest: Path) -> None:
     """Сохранить UploadFile на диск."""
-    data = upload.file.read()
     dest.parent.mkdir(parents=True, exist_ok=True)
-    dest.write_bytes(data)
+    with dest.open("wb") as f:
+        shutil.copyfileobj(upload.file, f, length=UPLOAD_CHUNK)
 
 
-def pdf_to_images(pdf_path: Path, out_dir: Path, dpi: int = 300) -> List[Path]:
-    """Конвертировать PDF в PNG-страницы (без кириллицы в именах)."""
+def pdf_to_images(
+    pdf_path: Path, out_dir: Path, dpi: int = RENDER_DPI, chunk: int = YOLO_BATCH
+) -> Iterator[Tuple[List[Path], List[np.ndarray]]]:
+    """
+    Конвертировать PDF в JPEG-страницы (без кириллицы в именах).
+    Отдаёт страницы пачками по `chunk` штук: пути и пиксели (BGR) в том же
+    порядке. В памяти одновременно не больше двух пачек — текущая и
+    следующая, которая рендерится, пока текущая идёт в YOLO.
+    """
     out_dir.mkdir(parents=True, exist_ok=True)
-    doc = fitz.open(pdf_path)
-    page_paths: List[Path] = []
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
 
     zoom = dpi / 72
-    mat = fitz.Matrix(zoom, zoom)
+    img_paths = [out_dir / f"page_{i + 1:03d}.jpg" for i in range(page_count)]
 
-    for i, page in enumerate(doc):
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        img_name = f"page_{i + 1:03d}.png"
-        img_path = out_dir / img_name
-        pix.save(img_path.as_posix())
-        page_paths.append(img_path)
+    # страницы рендерятся параллельно в отдельных процессах, порядок сохраняется
+    pool = get_render_pool()
 
-    doc.close()
-    return page_paths
+    def submit(start: int):
+        stop = min(start + chunk, page_count)
+        return [
+            pool.submit(render_page, pdf_path, i, zoom, img_paths[i])
+            for i in range(start, stop)
+        ]
+
+    pending = submit(0)
+    for start in range(0, page_count, chunk):
+        rendered = [f.result() for f in pending]
+        pending = submit(start + chunk)
+        yield [path for path, _ in rendered], [img for _, img in rendered]
 
 
 def image_from_upload(upload: UploadFile, out_path: Path) -> Path:
     """Сохранить одиночное изображение (png/jpg) в runtime."""
-    data = upload.file.read()
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_bytes(data)
+    with out_path.open("wb") as f:
+        shutil.copyfileobj(upload.file, f, length=UPLOAD_CHUNK)
     return out_path
 
 
-def run_yolo_on_image(img_path: Path, conf: float = 0.25) -> List[Detection]:
-    """Запустить YOLO на одной картинке и вернуть список Detection."""
-    results = model.predict(
-        source=str(img_path),
-        imgsz=1024,
-        conf=conf,
-        verbose=False,
-    )
-
+def _normalize_boxes(r) -> List[Detection]:
+    """Перевести боксы одного Results в список Detection (нормализованные [0,1])."""
     detections: List[Detection] = []
 
-    if not results:
-        return detections
-
-    r = results[0]
-    h_img, w_img = r.orig_shape  # (H, W)
+    h_img, w_img = r.orig_shape  # (H, W) — у каждой страницы свой размер
 
     boxes = r.boxes
-    if boxes is None:
+    if boxes is None or len(boxes) == 0:
         return detections
 
-    for i, (xyxy, cls, score) in enumerate(
-        zip(boxes.xyxy, boxes.cls, boxes.conf)
-    ):
-        x1, y1, x2, y2 = xyxy.tolist()
-        cid = int(cls.item())
-        conf_score = float(score.item())
-
-        if cid not in ID2LABEL:
-            continue
+    # один переход tensor → numpy на всё, вместо .tolist()/.item() на каждый бокс
+    xyxy = boxes.xyxy.cpu().numpy()
+    cls = boxes.cls.cpu().numpy().astype(np.int64)
+    conf = boxes.conf.cpu().numpy()
 
-        label: LABEL_TYPE = ID2LABEL[cid]  # type: ignore
+    # top-left + width/height, нормализованные [0,1] относительно размеров изображения
+    inv_w = 1.0 / w_img
+    inv_h = 1.0 / h_img
+    x = np.clip(xyxy[:, 0] * inv_w, 0.0, 1.0)
+    y = np.clip(xyxy[:, 1] * inv_h, 0.0, 1.0)
+    w = np.clip((xyxy[:, 2] - xyxy[:, 0]) * inv_w, 0.0, 1.0)
+    h = np.clip((xyxy[:, 3] - xyxy[:, 1]) * inv_h, 0.0, 1.0)
 
-        # приводим к top-left + width/height в пикселях
-        w_box = x2 - x1
-        h_box = y2 - y1
+    valid = np.isin(cls, _VALID_IDS)
 
-        # нормализуем [0,1] относительно размеров изображения
-        x_norm = max(0.0, min(1.0, x1 / w_img))
-        y_norm = max(0.0, min(1.0, y1 / h_img))
-        w_norm = max(0.0, min(1.0, w_box / w_img))
-        h_norm = max(0.0, min(1.0, h_box / h_img))
+    for i in np.flatnonzero(valid).tolist():
+        label: LABEL_TYPE = ID2LABEL[int(cls[i])]  # type: ignore
 
         detections.append(
             Detection(
                 id=f"det_{i}",
                 label=label,
-                score=conf_score,
-                x=x_norm,
-                y=y_norm,
-                w=w_norm,
-                h=h_norm,
+                score=float(conf[i]),
+                x=float(x[i]),
+                y=float(y[i]),
+                w=float(w[i]),
+                h=float(h[i]),
             )
         )
 
     return detections
 
 
+def _yolo_source(img: np.ndarray | Path):
+    """numpy-массив отдаём в YOLO как есть, путь — строкой."""
+    return img if isinstance(img, np.ndarray) else str(img)
+
+
+def run_yolo_on_image(img: np.ndarray | Path, conf: float = 0.25) -> List[Detection]:
+    """Запустить YOLO на одной картинке (путь или BGR-массив) и вернуть список Detection."""
+    results = model.predict(
+        source=_yolo_source(img),
+        imgsz=1024,
+        conf=conf,
+        verbose=False,
+    )
+
+    if not results:
+        return []
+
+    return _normalize_boxes(results[0])
+
+
+def run_yolo_batch(
+    images: List[np.ndarray | Path], conf: float = 0.25, batch: int = YOLO_BATCH
+) -> List[List[Detection]]:
+    """
+    Запустить YOLO на нескольких страницах пачками по `batch` штук.
+    Страница — путь к файлу или уже декодированный BGR-массив.
+    Возвращает список Detection для каждой страницы в том же порядке, что и images.
+    """
+    all_detections: List[List[Detection]] = []
+
+    if not images:
+        return all_detections
+
+    # список в source Ultralytics отдаёт одним батчем размера len(source),
+    # поэтому режем сами: не больше `batch` страниц за вызов (TensorRT-движок
+    # собран с batch=YOLO_BATCH, да и VRAM не резиновая).
+    # stream=True внутри пачки: Results сразу сворачиваются в Detection
+    for start in range(0, len(images), batch):
+        chunk = images[start:start + batch]
+        results = model.predict(
+            source=[_yolo_source(img) for img in chunk],
+            imgsz=1024,
+            conf=conf,
+            batch=len(chunk),
+            stream=True,
+            verbose=False,
+        )
+        for r in results:
+            all_detections.append(_normalize_boxes(r))
+
+    return all_detections
+
+
 # -------------------------------------------------------
 # Эндпоинты анализа
 # -------------------------------------------------------
@@ -215,64 +502,88 @@ async def analyze_document(file: UploadFile = File(...)):
     if not file.filename:
         raise HTTPException(status_code=400, detail="Empty filename")
 
-    doc_id = str(uuid.uuid4())
     original_name = file.filename
     suffix = Path(original_name).suffix.lower()
+    if suffix != ".pdf" and suffix not in IMAGE_SUFFIXES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported file type: {suffix}. Please upload PDF or image.",
+        )
+
+    # тот же файл уже анализировали — отдаём сохранённый результат без YOLO;
+    # хэширование и файловый I/O — в потоках, event loop не блокируется
+    digest = await asyncio.to_thread(upload_digest, file)
+    async with _CACHE_LOCK:
+        cached = await asyncio.to_thread(cached_result, digest)
+    if cached is not None:
+        try:
+            return await asyncio.to_thread(reuse_result, cached, original_name)
+        except FileNotFoundError:
+            pass  # исходный документ удалили прямо сейчас — анализируем заново
+
+    doc_id = str(uuid.uuid4())
 
     doc_dir = RUNTIME_DIR / doc_id
     pages_dir = doc_dir / "pages"
     pages_dir.mkdir(parents=True, exist_ok=True)
 
+    async with _ANALYZE_SEM:
+        doc_result = await _analyze_upload(file, doc_id, doc_dir, pages_dir, suffix)
+
+    async with _CACHE_LOCK:
+        await asyncio.to_thread(remember_result, digest, doc_id)
+
+    return doc_result
+
+
+async def _analyze_upload(
+    file: UploadFile, doc_id: str, doc_dir: Path, pages_dir: Path, suffix: str
+) -> DocResult:
+    """Растеризация + YOLO + сохранение результата для одного документа."""
     pages: List[Path] = []
+    page_detections: List[List[Detection]] = []
 
-    # 1) PDF → много страниц
+    # 1) PDF → много страниц: рендер и YOLO идут пачками по YOLO_BATCH,
+    # пиксели всего документа в памяти не держим
     if suffix == ".pdf":
         tmp_pdf_path = doc_dir / "source.pdf"
         save_upload_to_temp(file, tmp_pdf_path)
-        pages = pdf_to_images(tmp_pdf_path, pages_dir, dpi=300)
-
-    # 2) Картинка → одна "страница"
-    elif suffix in {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp"}:
+        chunks = pdf_to_images(tmp_pdf_path, pages_dir, RENDER_DPI)
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            chunk_paths, images = chunk
+            async with _MODEL_LOCK:
+                detections = await asyncio.to_thread(run_yolo_batch, images, YOLO_CONF)
+            pages.extend(chunk_paths)
+            page_detections.extend(detections)
+
+    # 2) Картинка → одна "страница" (тип файла уже проверен в analyze_document)
+    else:
         img_path = pages_dir / "page_001.png"
         image_from_upload(file, img_path)
         pages = [img_path]
+        async with _MODEL_LOCK:
+            page_detections = await asyncio.to_thread(run_yolo_batch, pages, YOLO_CONF)
 
-    else:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported file type: {suffix}. Please upload PDF or image.",
-        )
-
-    # 3) Запускаем YOLO по каждой странице
     page_results: List[PageResult] = []
 
-    for idx, page_path in enumerate(sorted(pages)):
-        detections = run_yolo_on_image(page_path, conf=0.25)
-
-        # URL для фронта: /static/<doc_id>/pages/page_001.png
-        rel_path = page_path.relative_to(RUNTIME_DIR).as_posix()
-        image_url = f"{BACKEND_BASE}{STATIC_URL}/{rel_path}"
-
+    for idx, (page_path, detections) in enumerate(zip(pages, page_detections)):
         page_results.append(
             PageResult(
                 pageIndex=idx,
-                imageUrl=image_url,
+                imageUrl=page_url(page_path),
                 detections=detections,
             )
         )
 
     doc_result = DocResult(
         id=doc_id,
-        filename=original_name,
+        filename=file.filename,
         pages=page_results,
     )
 
     # Сохраняем результат для последующей генерации отчёта
-    result_path = doc_dir / "result.json"
-    result_path.write_text(
-        doc_result.model_dump_json(indent=2, ensure_ascii=False),
-        encoding="utf-8",
-    )
+    result_path = doc_dir / RESULT_NAME
+    await asyncio.to_thread(save_doc_result, result_path, doc_result)
 
     return doc_result
 
@@ -280,14 +591,16 @@ async def analyze_document(file: UploadFile = File(...)):
 # -------------------------------------------------------
 # Генерация красивого summary-листа (тёмный стиль)
 # -------------------------------------------------------
-def build_summary_page(summary_path: Path, doc: DocResult, page_size) -> None:
+def build_summary_page(doc: DocResult, page_size) -> bytes:
     """
     Красивый dark-report под размер исходного PDF (A4, A3, ...).
+    Страница собирается в памяти, возвращаются байты PDF.
 
     page_size: (width, height) в пунктах (1/72").
     """
     width, height = page_size
-    c = canvas.Canvas(str(summary_path), pagesize=page_size)
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=page_size)
 
     # ---------- Цвета в стиле фронта ----------
     bg_page = HexColor("#020617")      # общий фон (почти чёрный)
@@ -319,14 +632,14 @@ def build_summary_page(summary_path: Path, doc: DocResult, page_size) -> None:
     logo_x = margin_x
     logo_y = height - header_h + (header_h - logo_side) / 2
 
-    if LOGO_PATH.exists():
+    if LOGO_IMAGE is not None:
         # используем PNG-логотип
         logo_size = header_h * 0.7
         logo_side = logo_size  # чтобы дальше отталкиваться от реального размера
         logo_x = width * 0.045
         logo_y = height - header_h * 0.5 - logo_size / 2
         c.drawImage(
-            str(LOGO_PATH),
+            LOGO_IMAGE,
             logo_x,
             logo_y,
             width=logo_size,
@@ -524,11 +837,40 @@ def build_summary_page(summary_path: Path, doc: DocResult, page_size) -> None:
 
     c.showPage()
     c.save()
+    return buf.getvalue()
 
 
 # -------------------------------------------------------
 # Эндпоинт скачивания отчёта
 # -------------------------------------------------------
+# (путь, mtime_ns) -> (PdfReader, размер файла); LRU, ограниченный по байтам
+_SOURCE_READERS: "OrderedDict[Tuple[str, int], Tuple[PdfReader, int]]" = OrderedDict()
+
+
+def _source_reader(source_pdf: Path) -> PdfReader:
+    """
+    PdfReader оригинального PDF, кэшируется между повторными скачиваниями.
+    mtime_ns входит в ключ, поэтому заменённый файл перечитывается.
+    Кэш ограничен SOURCE_CACHE_BYTES суммарного размера файлов, а не их числом.
+    """
+    key = (str(source_pdf), source_pdf.stat().st_mtime_ns)
+    hit = _SOURCE_READERS.get(key)
+    if hit is not None:
+        _SOURCE_READERS.move_to_end(key)
+        return hit[0]
+
+    # одно чтение в bytes; BytesIO поверх bytes их не копирует
+    data = source_pdf.read_bytes()
+    reader = PdfReader(io.BytesIO(data))
+    _SOURCE_READERS[key] = (reader, len(data))
+
+    total = sum(size for _, size in _SOURCE_READERS.values())
+    while total > SOURCE_CACHE_BYTES and len(_SOURCE_READERS) > 1:
+        _, (_, size) = _SOURCE_READERS.popitem(last=False)
+        total -= size
+    return reader
+
+
 @app.get("/docs/{doc_id}/report")
 async def download_report(doc_id: str):
     """
@@ -537,10 +879,10 @@ async def download_report(doc_id: str):
     2) оригинальный PDF, который пользователь залил.
     """
     doc_dir = RUNTIME_DIR / doc_id
-    result_json = doc_dir / "result.json"
+    result_json = doc_result_path(doc_dir)
     source_pdf = doc_dir / "source.pdf"  # pdf мы так называли в analyze_document
 
-    if not result_json.exists():
+    if result_json is None:
         raise HTTPException(status_code=404, detail="Analysis result not found")
     if not source_pdf.exists():
         raise HTTPException(
@@ -549,41 +891,34 @@ async def download_report(doc_id: str):
         )
 
     # читаем сохраненный DocResult
-    doc_data = json.loads(result_json.read_text(encoding="utf-8"))
-    doc_result = DocResult.model_validate(doc_data)
+    doc_result = load_doc_result(result_json)
 
     # читаем оригинальный pdf, получаем размер первой страницы
-    orig_reader = PdfReader(str(source_pdf))
+    orig_reader = _source_reader(source_pdf)
     first_page = orig_reader.pages[0]
     media_box = first_page.mediabox
     page_width = float(media_box.width)
     page_height = float(media_box.height)
     page_size = (page_width, page_height)
 
-    # временный summary.pdf
-    summary_path = doc_dir / "summary.pdf"
-    build_summary_page(summary_path, doc_result, page_size=page_size)
+    # summary-страница целиком в памяти, без временного файла
+    summary_bytes = build_summary_page(doc_result, page_size=page_size)
 
     # финальный отчет
     report_path = doc_dir / f"{doc_id}_report.pdf"
 
-    writer = PdfWriter()
-
-    # 1) summary
-    summary_reader = PdfReader(str(summary_path))
-    for page in summary_reader.pages:
-        writer.add_page(page)
+    # клонируем оригинал целиком: его уже сжатые потоки пишутся как есть,
+    # заново сериализуется только summary-страница
+    writer = PdfWriter(clone_from=orig_reader)
 
-    # 2) оригинальный pdf
-    for page in orig_reader.pages:
-        writer.add_page(page)
+    # summary — первой страницей
+    summary_reader = PdfReader(io.BytesIO(summary_bytes))
+    writer.insert_page(summary_reader.pages[0], 0)
 
-    with report_path.open("wb") as f:
+    # большой буфер, чтобы мелкие записи pypdf не превращались в отдельные syscalls
+    with report_path.open("wb", buffering=1 << 20) as f:
         writer.write(f)
 
-    # удаляем временный summary
-    summary_path.unlink(missing_ok=True)
-
     download_name = f"{Path(doc_result.filename).stem}_report.pdf"
 
     return FileResponse(
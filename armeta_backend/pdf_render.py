@@ -0,0 +1,64 @@
+# backend/pdf_render.py
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, Tuple
+
+import fitz  # PyMuPDF
+import numpy as np
+
+# Растеризация вынесена в отдельный лёгкий модуль: воркеры пула импортируют
+# только его, а не main.py (иначе каждый процесс грузил бы YOLO-модель).
+RENDER_WORKERS = min(os.cpu_count() or 1, 6)
+PAGE_JPEG_QUALITY = 90  # JPEG в разы меньше PNG и быстрее декодируется
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()  # первый вызов может прийти из нескольких to_thread сразу
+
+
+def get_render_pool() -> ProcessPoolExecutor:
+    """
+    Общий пул процессов для рендера страниц (создаётся при первом вызове).
+
+    Воркеры запускаются через spawn, а не fork: пул создаётся уже после
+    инициализации CUDA/TensorRT и при живых потоках uvicorn/torch, и
+    fork-нутый процесс унаследовал бы их блокировки в любом состоянии.
+    Spawn-воркер импортирует только этот модуль, так что стартует быстро.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _pool
+
+
+def render_page(
+    pdf_path: Path, page_index: int, zoom: float, img_path: Path
+) -> Tuple[Path, np.ndarray]:
+    """
+    Отрендерить одну страницу PDF в JPEG.
+    Каждый воркер открывает свой fitz.Document: PyMuPDF не потокобезопасен,
+    но между процессами документ не разделяется.
+
+    Возвращает путь к JPEG (для фронта) и BGR-массив пикселей (для YOLO),
+    чтобы инференс не декодировал только что записанный файл заново.
+    """
+    doc = fitz.open(pdf_path)
+    try:
+        page = doc[page_index]
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        img_path.write_bytes(pix.tobytes("jpg", jpg_quality=PAGE_JPEG_QUALITY))
+
+        # samples_mv — memoryview на буфер pixmap без копии (pix.samples копирует в bytes);
+        # единственная копия — перестановка каналов: Ultralytics ждёт BGR, как из cv2.imread
+        rgb = np.frombuffer(pix.samples_mv, np.uint8).reshape(pix.height, pix.width, pix.n)
+        bgr = np.ascontiguousarray(rgb[:, :, 2::-1])
+    finally:
+        doc.close()
+    return img_path, bgr
@@ -2,7 +2,6 @@
 
 import os
 import sys
-import json
 from pathlib import Path
 
 import numpy as np
@@ -15,15 +14,11 @@ PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-# ---------- Unicode-safe image IO (works with Cyrillic paths) ----------
-def load_rgb_unicode(path: Path) -> np.ndarray:
-    data = np.fromfile(str(path), dtype=np.uint8)
-    img = cv2.imdecode(data, cv2.IMREAD_COLOR)
-    if img is None:
-        raise FileNotFoundError(f"Cannot read image: {path}")
-    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+from src.preprocessing.annotation_io import load_annotations
+from src.preprocessing.resize_pad import load_rgb  # Unicode-safe (Cyrillic paths)
 
 
+# ---------- Unicode-safe image IO (works with Cyrillic paths) ----------
 def save_rgb_unicode(path: Path, img_rgb: np.ndarray):
     path.parent.mkdir(parents=True, exist_ok=True)
     bgr = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
@@ -51,15 +46,36 @@ CLASS_COLORS = {
 def draw_boxes(img_rgb, boxes):
     """boxes: list of (class_name, (x, y, w, h)) in *PNG pixel coords*"""
     out = img_rgb.copy()
-    for cls, (x, y, w, h) in boxes:
+    if not boxes:
+        return out
+
+    classes = [cls for cls, _ in boxes]
+    xywh = np.array([b for _, b in boxes], dtype=np.float64)
+
+    # corners as int, truncated like int(x) did
+    x1 = xywh[:, 0].astype(np.int32)
+    y1 = xywh[:, 1].astype(np.int32)
+    x2 = (xywh[:, 0] + xywh[:, 2]).astype(np.int32)
+    y2 = (xywh[:, 1] + xywh[:, 3]).astype(np.int32)
+
+    # (N, 4, 2) closed quads: one cv2.polylines call per class colour
+    pts = np.stack(
+        [np.stack([x1, y1], 1), np.stack([x2, y1], 1),
+         np.stack([x2, y2], 1), np.stack([x1, y2], 1)],
+        axis=1,
+    )
+    cls_arr = np.array(classes)
+    for cls in dict.fromkeys(classes):
+        color = CLASS_COLORS.get(cls, (255, 255, 255))
+        cv2.polylines(out, list(pts[cls_arr == cls]), True, color, 3)
+
+    # labels stay a short Python loop
+    for cls, x, y in zip(classes, x1.tolist(), y1.tolist()):
         color = CLASS_COLORS.get(cls, (255, 255, 255))
-        x1, y1 = int(x), int(y)
-        x2, y2 = int(x + w), int(y + h)
-        cv2.rectangle(out, (x1, y1), (x2, y2), color, 3)
         cv2.putText(
             out,
             cls,
-            (x1, max(0, y1 - 10)),
+            (x, max(0, y - 10)),
             cv2.FONT_HERSHEY_SIMPLEX,
             0.8,
             color,
@@ -71,8 +87,7 @@ def draw_boxes(img_rgb, boxes):
 
 def visualize():
     print("[VIS] Loading annotations...")
-    with open(ANNOT_PATH, "r", encoding="utf-8") as f:
-        ann = json.load(f)
+    ann = load_annotations(ANNOT_PATH)  # flat entries
 
     OUT_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -100,7 +115,7 @@ def visualize():
 
         # load PNG image
         try:
-            img_rgb = load_rgb_unicode(img_path)
+            img_rgb = load_rgb(img_path)
         except FileNotFoundError as e:
             print("[ERROR]", e)
             continue
@@ -118,8 +133,7 @@ def visualize():
             sx = sy = 1.0
 
         boxes = []
-        for item in page_ann:
-            ann_id, entry = next(iter(item.items()))
+        for entry in page_ann:
             cls = entry["category"]
             bbox = entry["bbox"]
 
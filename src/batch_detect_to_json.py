@@ -1,13 +1,30 @@
 # batch_detect_to_json.py
 
-import json
+import multiprocessing
+import os
+import queue
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import fitz                        # PyMuPDF
-from PIL import Image
+import numpy as np
+import orjson
+import torch
+import torch.nn.functional as F
 from ultralytics import YOLO
 
+from src.pdf_pages import iter_pdf_pages, load_image_page, render_chunk
+
+try:
+    from ultralytics.utils.nms import non_max_suppression
+except ImportError:  # старые версии ultralytics
+    from ultralytics.utils.ops import non_max_suppression
+
 
 # --- настройки ----------------------------------------------------
 
@@ -27,30 +44,83 @@ PDF_DPI = 200
 # Порог уверенности
 CONF_THRESH = 0.25
 
+# Сколько страниц отдаём YOLO за один вызов predict
+# (и сколько отрендеренных страниц держим в памяти одновременно)
+BATCH_SIZE = 8
+
+# TensorRT FP16-движок рядом с .pt; пересобирается, если .pt новее.
+# Максимальный батч зашит в движок, поэтому в имени — BATCH_SIZE:
+# у backend-а свой движок на свой батч, и они не перезаписывают друг друга
+ENGINE_PATH = MODEL_PATH.with_name(f"{MODEL_PATH.stem}.b{BATCH_SIZE}.engine")
+# метка «экспорт в TensorRT здесь не работает»: пока она новее .pt,
+# экспорт не перезапускается на каждом прогоне
+NO_ENGINE_MARKER = ENGINE_PATH.with_suffix(".no_engine")
+
+# Сколько готовых пачек страниц (по BATCH_SIZE) может ждать YOLO в очереди;
+# очередь и рендер идут пачками, поэтому память не зависит от длины документа
+QUEUE_CHUNKS = 2
+
+# Сколько пачек рендерится наперёд. Пачка при 200 DPI — около 90 МБ BGR,
+# поэтому это небольшая константа, а не число ядер: на 16 ядрах
+# по пачке на ядро дали бы 1.5–2 ГБ страниц в памяти
+RENDER_AHEAD = 3
+
+# Сколько процессов рендерят PDF: по одному на пачку в работе,
+# но не больше ядер минус одно (его оставляем под YOLO)
+RENDER_WORKERS = max(1, min(RENDER_AHEAD, (os.cpu_count() or 2) - 1))
+
+# Размер входа модели
+IMGSZ = 1024
+
+# Если есть CUDA — resize/letterbox/нормализация страниц идут на GPU
+DEVICE = "cuda" if torch.cuda.is_available() else None
+
+# IoU и max_det для NMS (как по умолчанию в model.predict)
+IOU_THRESH = 0.7
+MAX_DET = 300
+
+# .pt на CUDA через CUDA graph вместо model.predict (см. GraphedDetector).
+# Только по явному YOLO_CUDA_GRAPH=1: сеть и NMS вызываются мимо predictor-а
+# Ultralytics, поэтому при первой пачке результат сверяется с model.predict
+USE_CUDA_GRAPH = os.getenv("YOLO_CUDA_GRAPH", "0") == "1"
+
 
 # --- вспомогательные функции --------------------------------------
 
 
-def run_yolo_on_image(model: YOLO, img_path: Path) -> List[Dict]:
+# (scale, pad_left, pad_top, width, height) страницы после gpu_letterbox
+Letterbox = Tuple[float, int, int, int, int]
 
-    results = model.predict(
-        source=str(img_path),
-        imgsz=1024,
-        conf=CONF_THRESH,
-        verbose=False,
-    )
 
-    if not results:
-        return []
+def results_to_annotations(
+    r, letterbox: Optional[Letterbox] = None
+) -> List[Dict]:
+    """
+    Перевести один Results в список аннотаций формата selected_annotations.json.
 
-    r = results[0]
+    letterbox = (scale, pad_left, pad_top, width, height), если на вход модели
+    подавался уже letterbox-тензор (см. gpu_letterbox): боксы переводятся
+    обратно в координаты исходной страницы и обрезаются по её границам
+    (как scale_boxes в Ultralytics).
+    """
     boxes = r.boxes
     if boxes is None:
         return []
 
+    return boxes_to_annotations(boxes.xyxy, boxes.cls, letterbox)
+
+
+def boxes_to_annotations(
+    xyxy_all, cls_all, letterbox: Optional[Letterbox] = None
+) -> List[Dict]:
+    """То же, что results_to_annotations, но по «сырым» тензорам xyxy (N, 4) и cls (N,)."""
     annotations = []
-    for i, (xyxy, cls) in enumerate(zip(boxes.xyxy, boxes.cls), start=1):
+    for xyxy, cls in zip(xyxy_all, cls_all):
         x1, y1, x2, y2 = [float(v) for v in xyxy.tolist()]
+        if letterbox is not None:
+            scale, pad_left, pad_top, page_w, page_h = letterbox
+            x1, x2 = [min(max((v - pad_left) / scale, 0.0), page_w) for v in (x1, x2)]
+            y1, y2 = [min(max((v - pad_top) / scale, 0.0), page_h) for v in (y1, y2)]
         w = x2 - x1
         h = y2 - y1
         area = w * h
@@ -60,25 +130,243 @@ def run_yolo_on_image(model: YOLO, img_path: Path) -> List[Dict]:
 
         annotations.append(
             {
-                f"annotation_{i}": {
-                    "category": category,
-                    "bbox": {
-                        "x": x1,
-                        "y": y1,
-                        "width": w,
-                        "height": h,
-                    },
-                    "area": area,
-                }
+                "category": category,
+                "bbox": {
+                    "x": x1,
+                    "y": y1,
+                    "width": w,
+                    "height": h,
+                },
+                "area": area,
             }
         )
 
     return annotations
 
 
-def process_pdf(model: YOLO, pdf_path: Path, tmp_dir: Path) -> Dict:
+def gpu_letterbox(
+    imgs: List[np.ndarray], size: int = IMGSZ
+) -> Tuple[torch.Tensor, List[Letterbox]]:
     """
-    Обрабатывает один PDF: возвращает dict вида
+    Препроцессинг YOLO на GPU: BGR HWC uint8 → RGB BCHW float [0,1],
+    resize с сохранением пропорций + паддинг до size×size (как letterbox
+    в Ultralytics, фон 114). На CPU остаётся только копирование uint8 на карту.
+
+    Уменьшение — с antialias (ближе к cv2.INTER_AREA, которым Ultralytics
+    уменьшает картинки при обучении), иначе страница, сжатая в ~2 раза,
+    приходит в модель с алиасингом.
+
+    Возвращает тензор и (scale, pad_left, pad_top, width, height) для каждой картинки.
+    """
+    batch = torch.full((len(imgs), 3, size, size), 114 / 255.0, device=DEVICE)
+    metas: List[Letterbox] = []
+
+    for i, img in enumerate(imgs):
+        h, w = img.shape[:2]
+        scale = min(size / h, size / w)
+        new_h, new_w = round(h * scale), round(w * scale)
+        pad_top = (size - new_h) // 2
+        pad_left = (size - new_w) // 2
+
+        t = torch.from_numpy(img).to(DEVICE, non_blocking=True)
+        # HWC → CHW, BGR → RGB, /255 — всё уже на карте
+        t = t.permute(2, 0, 1).flip(0).unsqueeze(0).float().div_(255.0)
+        t = F.interpolate(
+            t, size=(new_h, new_w), mode="bilinear",
+            align_corners=False, antialias=scale < 1,
+        )
+
+        batch[i, :, pad_top:pad_top + new_h, pad_left:pad_left + new_w] = t[0]
+        metas.append((scale, pad_left, pad_top, w, h))
+
+    return batch, metas
+
+
+class GraphedDetector:
+    """
+    Прямой проход сети, записанный один раз в CUDA graph для фиксированного
+    FP32-входа (BATCH_SIZE, 3, IMGSZ, IMGSZ). Каждая следующая пачка — это
+    copy_ во входной буфер + graph.replay(): без накладных расходов
+    model.predict и без запуска каждого ядра из Python. NMS — как в predict.
+
+    Поддерживается только обычная Detect-голова, отдающая (B, 4 + nc, N);
+    на что-то другое (end2end / NMS-free головы и т.п.) — TypeError.
+    """
+
+    def __init__(self, model: YOLO):
+        self.net = model.model.to(DEVICE).fuse(verbose=False).eval()
+        if getattr(self.net.model[-1], "end2end", False):
+            raise TypeError("end2end head is not supported")
+        self.static_input = torch.zeros((BATCH_SIZE, 3, IMGSZ, IMGSZ), device=DEVICE)
+
+        with torch.no_grad():
+            # прогрев на отдельном стриме — обязательно перед захватом графа
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self.net(self.static_input)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                out = self.net(self.static_input)
+        # в eval Detect-голова возвращает (preds, raw_feats)
+        self.static_output = out[0] if isinstance(out, (tuple, list)) else out
+
+        expected = 4 + len(model.names)
+        if not (
+            isinstance(self.static_output, torch.Tensor)
+            and self.static_output.ndim == 3
+            and self.static_output.shape[1] == expected
+        ):
+            raise TypeError(f"unexpected head output, expected (B, {expected}, N)")
+
+    def __call__(self, batch: torch.Tensor) -> List[torch.Tensor]:
+        """batch: (n ≤ BATCH_SIZE, 3, IMGSZ, IMGSZ) → n тензоров (k, 6): xyxy, conf, cls."""
+        n = batch.shape[0]
+        self.static_input[:n].copy_(batch)
+        self.static_input[n:].zero_()
+        self.graph.replay()
+        return non_max_suppression(
+            self.static_output[:n],
+            conf_thres=CONF_THRESH,
+            iou_thres=IOU_THRESH,
+            max_det=MAX_DET,
+        )
+
+
+def _matches_predict(model: YOLO, detector: GraphedDetector, batch: torch.Tensor) -> bool:
+    """Сверка на одной пачке: те же боксы и классы, что у model.predict (±1 px)."""
+    ours = detector(batch)
+    ref = model.predict(
+        source=batch,
+        imgsz=IMGSZ,
+        conf=CONF_THRESH,
+        iou=IOU_THRESH,
+        max_det=MAX_DET,
+        verbose=False,
+    )
+    for det, r in zip(ours, ref):
+        if len(det) != len(r.boxes):
+            return False
+        if len(det) and not (
+            torch.allclose(det[:, :4], r.boxes.xyxy, atol=1.0)
+            and torch.equal(det[:, 5], r.boxes.cls)
+        ):
+            return False
+    return True
+
+
+# модель -> её CUDA graph (или None, если граф не подошёл); слабые ключи,
+# чтобы запись не пережила модель и не досталась новой по тому же id
+_graphed: "weakref.WeakKeyDictionary[YOLO, Optional[GraphedDetector]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _graphed_detector(model: YOLO, batch: torch.Tensor) -> Optional[GraphedDetector]:
+    """
+    Один CUDA graph на модель на всю папку PDF (строится при первой пачке
+    и сверяется на ней с model.predict). None — граф не захватился или
+    разошёлся с predict: дальше эта модель идёт через model.predict.
+    """
+    if model not in _graphed:
+        detector = None
+        try:
+            detector = GraphedDetector(model)
+            if not _matches_predict(model, detector, batch):
+                print("CUDA graph output differs from model.predict, using model.predict")
+                detector = None
+        except Exception as e:
+            print(f"CUDA graph capture failed ({e}), using model.predict")
+            detector = None
+        _graphed[model] = detector
+    return _graphed[model]
+
+
+def load_model() -> YOLO:
+    """
+    Загрузить YOLO в самом быстром доступном бэкенде.
+
+    Если .engine нет или он старше .pt — экспортируем .pt в TensorRT FP16
+    (imgsz=IMGSZ, до BATCH_SIZE страниц за вызов). Если рядом лежит только
+    .engine — берём его как есть. Если TensorRT/CUDA недоступны — остаёмся
+    на PyTorch и запоминаем это в NO_ENGINE_MARKER до следующей смены .pt.
+    """
+    model_mtime = MODEL_PATH.stat().st_mtime if MODEL_PATH.exists() else None
+    if ENGINE_PATH.exists() and (
+        model_mtime is None or ENGINE_PATH.stat().st_mtime >= model_mtime
+    ):
+        return YOLO(str(ENGINE_PATH), task="detect")
+
+    # без CUDA TensorRT не собрать, без .pt — нечего экспортировать
+    # (тогда YOLO сам сообщит, что файла нет)
+    if DEVICE is None or model_mtime is None:
+        return YOLO(str(MODEL_PATH), task="detect")
+    if NO_ENGINE_MARKER.exists() and NO_ENGINE_MARKER.stat().st_mtime >= model_mtime:
+        print(f"TensorRT export failed before (see {NO_ENGINE_MARKER}), using PyTorch model")
+        return YOLO(str(MODEL_PATH), task="detect")
+
+    print(f"Exporting {MODEL_PATH.name} to TensorRT FP16...")
+    try:
+        exported = YOLO(str(MODEL_PATH)).export(
+            format="engine",
+            half=True,
+            imgsz=IMGSZ,
+            batch=BATCH_SIZE,
+            dynamic=True,  # последняя пачка документа обычно меньше BATCH_SIZE
+        )
+        # Ultralytics всегда пишет <stem>.engine — переименовываем в свой файл
+        Path(exported).replace(ENGINE_PATH)
+    except Exception as e:
+        print(f"TensorRT export failed ({e}), using PyTorch model")
+        NO_ENGINE_MARKER.write_text(f"{e}\n", encoding="utf-8")
+        return YOLO(str(MODEL_PATH), task="detect")
+
+    NO_ENGINE_MARKER.unlink(missing_ok=True)
+    return YOLO(str(ENGINE_PATH), task="detect")
+
+
+def predict_pages(model: YOLO, imgs: List[np.ndarray]) -> List[List[Dict]]:
+    """Один вызов YOLO на пачку страниц, аннотации для каждой страницы по порядку."""
+    if DEVICE is not None:
+        tensor, metas = gpu_letterbox(imgs)
+        is_engine = not isinstance(model.model, torch.nn.Module)
+
+        if USE_CUDA_GRAPH and not is_engine:
+            detector = _graphed_detector(model, tensor)
+            if detector is not None:
+                detections = detector(tensor)
+                return [
+                    boxes_to_annotations(det[:, :4], det[:, 5], m)
+                    for det, m in zip(detections, metas)
+                ]
+
+        # letterbox-тензор уже готов; у TensorRT-движка граф собран самим TensorRT
+        results = model.predict(
+            source=tensor,
+            imgsz=IMGSZ,
+            conf=CONF_THRESH,
+            half=is_engine,
+            verbose=False,
+        )
+        return [results_to_annotations(r, m) for r, m in zip(results, metas)]
+
+    results = model.predict(
+        source=imgs,
+        imgsz=IMGSZ,
+        conf=CONF_THRESH,
+        batch=len(imgs),
+        verbose=False,
+    )
+    return [results_to_annotations(r) for r in results]
+
+
+def _infer_pages(model: YOLO, pages: List[np.ndarray]) -> Dict:
+    """
+    GPU-часть: YOLO по уже отрендеренным страницам, пачками по BATCH_SIZE.
+    Возвращает dict вида
     {
       "page_1": {
         "annotations": [...],
@@ -87,54 +375,106 @@ def process_pdf(model: YOLO, pdf_path: Path, tmp_dir: Path) -> Dict:
       ...
     }
     """
-    doc = fitz.open(pdf_path)
     pages_dict: Dict[str, Dict] = {}
 
-    zoom = PDF_DPI / 72.0
-    mat = fitz.Matrix(zoom, zoom)
+    for start in range(0, len(pages), BATCH_SIZE):
+        batch = pages[start:start + BATCH_SIZE]
+        batch_anns = predict_pages(model, batch)
 
-    for page_index, page in enumerate(doc, start=1):
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        width, height = pix.width, pix.height
+        for page_index, (img, anns) in enumerate(
+            zip(batch, batch_anns), start=start + 1
+        ):
+            height, width = img.shape[:2]
 
-        # сохраняем временную картинку для YOLO
-        img_path = tmp_dir / f"{pdf_path.stem}_page_{page_index}.png"
-        pix.save(str(img_path))
+            page_key = f"page_{page_index}"
+            pages_dict[page_key] = {
+                "annotations": anns,
+                "page_size": {"width": width, "height": height},
+            }
 
-        anns = run_yolo_on_image(model, img_path)
+    return pages_dict
 
-        page_key = f"page_{page_index}"
-        pages_dict[page_key] = {
-            "annotations": anns,
-            "page_size": {"width": width, "height": height},
-        }
 
-    doc.close()
+def process_pdf(model: YOLO, pdf_path: Path) -> Dict:
+    """
+    Обрабатывает один PDF в текущем процессе, без пула.
+    Формат результата — как у _infer_pages. Страницы рендерятся и
+    отдаются в YOLO пачками, так что в памяти не больше одной пачки.
+    """
+    pages_dict: Dict[str, Dict] = {}
+
+    with fitz.open(pdf_path) as doc:
+        pages = iter_pdf_pages(doc, PDF_DPI)
+        while batch := list(islice(pages, BATCH_SIZE)):
+            # _infer_pages нумерует пачку с page_1 — продолжаем сквозную нумерацию
+            for page in _infer_pages(model, batch).values():
+                pages_dict[f"page_{len(pages_dict) + 1}"] = page
+
     return pages_dict
 
 
-def process_image(model: YOLO, img_path: Path) -> Dict:
+def _chunk_jobs(paths: List[Path]) -> Iterator[Tuple[Path, int, int]]:
     """
-    Обрабатывает одиночную картинку как документ из одной страницы.
-    Возвращает:
-    {
-      "page_1": {
-        "annotations": [...],
-        "page_size": {"width": ..., "height": ...}
-      }
-    }
+    Задания (path, start, stop) по порядку paths: PDF режется на пачки
+    по BATCH_SIZE страниц, картинка — одно задание (path, 0, 1).
+    Пустой PDF даёт одно пустое задание, чтобы попасть в результат.
     """
-    with Image.open(img_path) as im:
-        width, height = im.size
+    for path in paths:
+        if path.suffix.lower() != ".pdf":
+            yield path, 0, 1
+            continue
+        with fitz.open(path) as doc:
+            page_count = doc.page_count
+        if page_count == 0:
+            yield path, 0, 0
+        for start in range(0, page_count, BATCH_SIZE):
+            yield path, start, min(start + BATCH_SIZE, page_count)
 
-    anns = run_yolo_on_image(model, img_path)
 
-    return {
-        "page_1": {
-            "annotations": anns,
-            "page_size": {"width": width, "height": height},
-        }
-    }
+def _iter_rendered(
+    pool: ProcessPoolExecutor, paths: List[Path], ahead: int
+) -> Iterator[Tuple[Path, List[np.ndarray]]]:
+    """
+    Отдаёт пары (path, пачка страниц) по порядку paths.
+    В работе держим не больше `ahead` пачек: пул рендерит следующие,
+    пока YOLO считает текущую, но ни папка, ни длинный PDF разом
+    в память не попадают.
+    """
+    def submit(job: Tuple[Path, int, int]):
+        path, start, stop = job
+        if path.suffix.lower() == ".pdf":
+            return path, pool.submit(render_chunk, path, start, stop, PDF_DPI)
+        return path, pool.submit(load_image_page, path)
+
+    jobs = _chunk_jobs(paths)
+    pending = deque(submit(job) for job in islice(jobs, ahead))
+
+    while pending:
+        path, future = pending.popleft()
+        next_job = next(jobs, None)
+        if next_job is not None:
+            pending.append(submit(next_job))
+        yield path, future.result()
+
+
+def _produce_chunks(
+    pool: ProcessPoolExecutor,
+    paths: List[Path],
+    q: "queue.Queue",
+) -> None:
+    """
+    Поток-производитель: кладёт в q пары (path, пачка страниц) по порядку
+    paths, в конце — None. Ожидание рендера PDF и чтения картинок идёт здесь,
+    пока основной поток гоняет YOLO по предыдущей пачке.
+    Ошибка пересылается в очередь и поднимается в основном потоке.
+    """
+    try:
+        for item in _iter_rendered(pool, paths, ahead=RENDER_AHEAD):
+            q.put(item)
+    except BaseException as e:
+        q.put(e)
+        return
+    q.put(None)
 
 
 def build_annotations_for_folder(
@@ -145,36 +485,61 @@ def build_annotations_for_folder(
     Обходит все PDF и изображения в папке input_dir,
     формирует JSON наподобие selected_annotations.json и сохраняет его.
     """
-    model = YOLO(str(MODEL_PATH))
+    model = load_model()
 
     input_dir = input_dir.resolve()
-    tmp_dir = input_dir / "_tmp_pages"
-    tmp_dir.mkdir(exist_ok=True)
 
     result: Dict[str, Dict] = {}
 
     pdf_exts = {".pdf"}
     img_exts = {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp"}
 
-    for path in sorted(input_dir.iterdir()):
-        if not path.is_file():
-            continue
+    paths = [
+        p for p in sorted(input_dir.iterdir())
+        if p.is_file() and p.suffix.lower() in pdf_exts | img_exts
+    ]
+
+    # PDF рендерятся параллельно в процессах пачками по BATCH_SIZE страниц;
+    # поток-производитель складывает готовые пачки в ограниченную очередь,
+    # а основной поток только гоняет по ним YOLO — GPU не ждёт ни рендера,
+    # ни чтения картинок.
+    # spawn, не fork: к этому моменту load_model уже поднял CUDA, а пул
+    # (с 3.9) запускает воркеры по требованию, пока основной поток гоняет
+    # инференс — fork-нутый процесс унаследовал бы CUDA/блокировки torch.
+    # Сами задачи живут в лёгком src.pdf_pages
+    with ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        q: "queue.Queue" = queue.Queue(maxsize=QUEUE_CHUNKS)
+        producer = threading.Thread(
+            target=_produce_chunks,
+            args=(pool, paths, q),
+            daemon=True,
+        )
+        producer.start()
+
+        while (item := q.get()) is not None:
+            if isinstance(item, BaseException):
+                raise item
+            path, pages = item
 
-        suffix = path.suffix.lower()
+            if path.name not in result:
+                kind = "PDF" if path.suffix.lower() in pdf_exts else "image"
+                print(f"Processing {kind}: {path.name}")
+                result[path.name] = {}
 
-        # PDF
-        if suffix in pdf_exts:
-            print(f"Processing PDF: {path.name}")
-            result[path.name] = process_pdf(model, path, tmp_dir)
+            # _infer_pages нумерует пачку с page_1 — продолжаем сквозную нумерацию
+            pages_dict = result[path.name]
+            for page in _infer_pages(model, pages).values():
+                pages_dict[f"page_{len(pages_dict) + 1}"] = page
 
-        # Картинки
-        elif suffix in img_exts:
-            print(f"Processing image: {path.name}")
-            result[path.name] = process_image(model, path)
+        producer.join()
 
     # сохраняем JSON
-    with output_json.open("w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    # orjson пишет UTF-8 как есть (кириллица в именах файлов не экранируется)
+    with output_json.open("wb") as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
 
     print(f"\nSaved annotations to: {output_json}")
 
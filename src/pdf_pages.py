@@ -0,0 +1,52 @@
+# src/pdf_pages.py
+
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import fitz                        # PyMuPDF
+import numpy as np
+from PIL import Image
+
+# Растеризация для batch_detect_to_json вынесена в отдельный лёгкий модуль
+# (без torch/ultralytics): задачи пула рендера ссылаются только на него.
+
+
+def iter_pdf_pages(
+    doc: fitz.Document,
+    dpi: int,
+    start: Optional[int] = None,
+    stop: Optional[int] = None,
+) -> Iterator[np.ndarray]:
+    """
+    Рендерить страницы PDF [start, stop) по одной в BGR numpy-массивы
+    (без записи на диск). По умолчанию — весь документ.
+    """
+    zoom = dpi / 72.0
+    mat = fitz.Matrix(zoom, zoom)
+
+    for page in doc.pages(start, stop):
+        pix = page.get_pixmap(matrix=mat, alpha=False)
+        # samples_mv — view на буфер pixmap, без копии в bytes (в отличие от pix.samples)
+        rgb = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(
+            pix.height, pix.width, pix.n
+        )
+        # Ultralytics ждёт numpy-картинки в BGR (как cv2.imread);
+        # перестановка каналов — единственная копия страницы
+        bgr = np.ascontiguousarray(rgb[:, :, 2::-1])
+        # отпускаем pixmap до рендера следующей страницы,
+        # чтобы два буфера страницы не жили одновременно
+        del rgb, pix
+        yield bgr
+
+
+def render_chunk(pdf_path: Path, start: int, stop: int, dpi: int) -> List[np.ndarray]:
+    """CPU-часть: отрендерить страницы PDF [start, stop) (запускается в пуле процессов)."""
+    with fitz.open(pdf_path) as doc:
+        return list(iter_pdf_pages(doc, dpi, start, stop))
+
+
+def load_image_page(img_path: Path) -> List[np.ndarray]:
+    """Одиночная картинка как документ из одной BGR-страницы."""
+    with Image.open(img_path) as im:
+        rgb = np.asarray(im.convert("RGB"))
+    return [np.ascontiguousarray(rgb[:, :, ::-1])]
@@ -0,0 +1,40 @@
+# src/preprocessing/annotation_io.py
+
+from pathlib import Path
+
+import orjson
+
+
+def _flat_annotation(item: dict) -> dict:
+    """One annotation entry in the flat schema; nested entries are unwrapped."""
+    if "category" in item:
+        return item
+    if len(item) == 1:
+        inner = next(iter(item.values()))
+        if isinstance(inner, dict) and "category" in inner:
+            return inner
+    raise ValueError(f"Unrecognised annotation entry: {item!r}")
+
+
+def load_annotations(path) -> dict:
+    """
+    Load an annotations JSON (selected_annotations.json format) with orjson.
+
+    Every page's "annotations" list is returned in the flat schema:
+        [{"category": ..., "bbox": {...}, "area": ...}, ...]
+
+    Entries in the older nested schema ({"annotation_1": {...}}, e.g. the
+    original hackathon annotations) are unwrapped here, once, so readers can
+    use each item directly. The schema is checked per entry, so mixed files
+    load correctly; anything that is neither raises ValueError.
+    """
+    with Path(path).open("rb") as f:
+        annotations = orjson.loads(f.read())
+
+    for pages in annotations.values():
+        for page in pages.values():
+            items = page.get("annotations")
+            if items:
+                page["annotations"] = [_flat_annotation(item) for item in items]
+
+    return annotations
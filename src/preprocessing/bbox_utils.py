@@ -1,5 +1,7 @@
 from typing import Tuple
 
+import numpy as np
+
 
 def convert_orig_to_preprocessed(x, y, w, h, meta):
     """
@@ -47,3 +49,55 @@ def xywh_to_yolo(x, y, w, h, size=1024):
     wn = w / size
     hn = h / size
     return xc, yc, wn, hn
+
+
+# ---------- Batched variants: boxes as an (N, 4) array of x, y, w, h ----------
+
+def orig_to_yolo_batch(xywh: np.ndarray, meta, size=1024) -> np.ndarray:
+    """
+    convert_orig_to_preprocessed → clip_bbox → xywh_to_yolo for all boxes of
+    a page at once, fused into one pass over a single output buffer.
+
+    scale / pad / 1/size are folded into scalars up front, so each column is
+    touched by a handful of in-place ufuncs and no temporaries are allocated.
+    """
+    s = float(meta["scale"])
+    inv = 1.0 / size
+
+    out = np.multiply(xywh, s, dtype=np.float64)
+    x, y, w, h = out[:, 0], out[:, 1], out[:, 2], out[:, 3]
+
+    # scale + pad, clipped into the square
+    x += meta["pad_left"]
+    y += meta["pad_top"]
+    np.clip(x, 0, size - 1, out=x)
+    np.clip(y, 0, size - 1, out=y)
+
+    # w = max(1, min(w, size - x)), same for h
+    np.minimum(w, size - x, out=w)
+    np.minimum(h, size - y, out=h)
+    np.maximum(w, 1, out=w)
+    np.maximum(h, 1, out=h)
+
+    # centre + normalise
+    x += w * 0.5
+    y += h * 0.5
+    out *= inv
+    return out
+
+
+def page_to_yolo_batch(xywh: np.ndarray, sx, sy, img_w, img_h) -> np.ndarray:
+    """
+    Boxes in PDF/page coords → YOLO normalized coords of a raw page image.
+
+    sx, sy: page → image scale per axis; img_w, img_h: image size in pixels.
+
+    Scale and normalisation fold into one factor per axis (sx / img_w),
+    so each box costs one multiply per coordinate and no divisions; pages
+    without page_size (sx = sy = 1) need no separate path.
+    """
+    fx = sx / img_w
+    fy = sy / img_h
+    out = xywh * np.array([fx, fy, fx, fy], dtype=np.float64)
+    out[:, :2] += out[:, 2:] * 0.5
+    return out
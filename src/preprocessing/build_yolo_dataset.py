@@ -1,14 +1,13 @@
-import json
-import shutil
 import random
 from pathlib import Path
-from collections import Counter
 
-from src.preprocessing.bbox_utils import (
-    convert_orig_to_preprocessed,
-    xywh_to_yolo,
-    clip_bbox,
-)
+import numpy as np
+import orjson
+
+from src.preprocessing.annotation_io import load_annotations
+
+from src.preprocessing.bbox_utils import orig_to_yolo_batch
+from src.preprocessing.file_utils import fast_copy, write_yolo_labels
 
 # Map your categories → YOLO class IDs
 CLASS_MAP = {
@@ -34,12 +33,18 @@ def build_yolo_dataset(
 
     random.seed(seed)
 
-    # --- Load JSONs ---
-    with open(annotations_json, "r", encoding="utf-8") as f:
-        annotations = json.load(f)
+    # --- Load JSONs (orjson: C parser, several times faster than json.load) ---
+    annotations = load_annotations(annotations_json)  # flat entries
 
-    with open(metadata_json, "r", encoding="utf-8") as f:
-        metadata = json.load(f)
+    with open(metadata_json, "rb") as f:
+        metadata = orjson.loads(f.read())
+
+    # flat (pdf_key, page_key) -> annotations index, built once
+    page_index = {
+        (pdf_key, page_key): page["annotations"]
+        for pdf_key, pages in annotations.items()
+        for page_key, page in pages.items()
+    }
 
     preproc_dir = Path(preproc_dir)
     out_dir = Path(out_dir)
@@ -55,8 +60,12 @@ def build_yolo_dataset(
 
     preproc_images = sorted(preproc_dir.glob("*.png"))
 
-    # --- Build per-image records with class presence info ---
-    records = []  # one entry per image with classes on that page
+    # --- Build per-image columns with class presence info ---
+    # struct-of-arrays: one list/array per field instead of a dict per image
+    img_paths = []    # preprocessed PNG per image
+    metas = []        # preprocessing metadata per image
+    page_annots = []  # raw annotations per image
+    class_rows = []   # class ids present on each page
 
     for img_path in preproc_images:
         filename = img_path.name       # "АПЗ-2_page_001.png"
@@ -72,148 +81,120 @@ def build_yolo_dataset(
 
         pdf_key = pdf_name + ".pdf"
 
-        if pdf_key not in annotations:
-            # no annotations for this pdf at all
-            page_annots = []
-        else:
-            pages = annotations[pdf_key]
-            if page_key not in pages:
-                page_annots = []
-            else:
-                page_annots = pages[page_key]["annotations"]
-
         if filename not in metadata:
             print("[WARN] No metadata for", filename)
             continue
-        meta = metadata[filename]
 
-        # collect set of classes present on this page
-        classes_on_page = set()
-        for ann_item in page_annots:
-            entry = next(iter(ann_item.values()))
-            cls = entry["category"]
-            if cls in CLASS_MAP:
-                classes_on_page.add(cls)
-
-        records.append(
-            {
-                "img_path": img_path,
-                "filename": filename,
-                "stem": stem,
-                "pdf_key": pdf_key,
-                "page_key": page_key,
-                "meta": meta,
-                "annotations": page_annots,
-                "classes": classes_on_page,
-            }
+        # no entry → no annotations for this page / pdf
+        annots = page_index.get((pdf_key, page_key), [])
+
+        img_paths.append(img_path)
+        metas.append(metadata[filename])
+        page_annots.append(annots)
+        class_rows.append(
+            [
+                CLASS_MAP[cls]
+                for cls in (a["category"] for a in annots)
+                if cls in CLASS_MAP
+            ]
         )
 
-    if not records:
+    if not img_paths:
         print("[YOLO] No valid records found, aborting.")
         return
 
+    # class_mask[i, c] — image i contains class c at least once
+    N = len(img_paths)
+    class_mask = np.zeros((N, len(CLASS_MAP)), dtype=bool)
+    for i, cids in enumerate(class_rows):
+        class_mask[i, cids] = True
+
+    class_names = list(CLASS_MAP)
+
     # --- Compute stratified split targets ---
-    N = len(records)
     target_val_images = max(1, int(N * (1 - train_ratio)))
 
     # count how many images contain each class at least once
-    img_class_counts = Counter()
-    for rec in records:
-        for c in rec["classes"]:
-            img_class_counts[c] += 1
+    img_class_counts = class_mask.sum(axis=0)
 
-    print("[STRAT] Image-level class counts:", img_class_counts)
+    print("[STRAT] Image-level class counts:", dict(zip(class_names, img_class_counts.tolist())))
 
-    # for each class, how many val images we want
-    target_val_per_class = {}
-    for c, count in img_class_counts.items():
-        if count == 0:
-            continue
-        # proportionally scale, but at least 1 if possible
-        target = int(round(target_val_images * (count / N)))
-        target_val_per_class[c] = max(1, target)
+    # for each class, how many val images we want:
+    # proportionally scaled, but at least 1 if the class occurs at all
+    target_val_per_class = np.where(
+        img_class_counts > 0,
+        np.maximum(1, np.round(target_val_images * img_class_counts / N)),
+        0,
+    ).astype(int)
 
-    print("[STRAT] Target val images per class:", target_val_per_class)
+    print("[STRAT] Target val images per class:", dict(zip(class_names, target_val_per_class.tolist())))
 
     # --- Stratified assignment of images to val ---
-    random.shuffle(records)
+    order = list(range(N))
+    random.shuffle(order)
+    order = np.asarray(order)
 
-    val_indices = set()
-    val_class_counts = Counter()
+    is_val = np.zeros(N, dtype=bool)
+    n_val = 0
+    val_class_counts = np.zeros(len(CLASS_MAP), dtype=int)
 
-    for i, rec in enumerate(records):
-        if len(val_indices) >= target_val_images:
+    for i in order:
+        if n_val >= target_val_images:
             break
 
-        # if this image has no classes, skip for now (can be added later)
-        if not rec["classes"]:
-            continue
-
-        # check if adding this image helps fill some class target
-        needs_any_class = False
-        for c in rec["classes"]:
-            if c in target_val_per_class and val_class_counts[c] < target_val_per_class[c]:
-                needs_any_class = True
-                break
-
-        if needs_any_class:
-            val_indices.add(i)
-            for c in rec["classes"]:
-                val_class_counts[c] += 1
+        # add the image if it helps fill some class target
+        # (images without classes are skipped for now, can be added later)
+        row = class_mask[i]
+        if (row & (val_class_counts < target_val_per_class)).any():
+            is_val[i] = True
+            n_val += 1
+            val_class_counts += row
 
     # if val still too small, fill with remaining images (even if empty)
-    for i, rec in enumerate(records):
-        if len(val_indices) >= target_val_images:
-            break
-        if i in val_indices:
-            continue
-        val_indices.add(i)
+    remaining = order[~is_val[order]]
+    is_val[remaining[: max(0, target_val_images - n_val)]] = True
 
-    print("[STRAT] Final val size:", len(val_indices))
-    print("[STRAT] Class counts in val:", val_class_counts)
+    print("[STRAT] Final val size:", int(is_val.sum()))
+    print("[STRAT] Class counts in val:", dict(zip(class_names, val_class_counts.tolist())))
 
     # --- Now actually write images + labels using this split ---
-    for i, rec in enumerate(records):
-        img_path = rec["img_path"]
-        filename = rec["filename"]
-        stem = rec["stem"]
-        page_annots = rec["annotations"]
-        meta = rec["meta"]
+    for i in order:
+        img_path = img_paths[i]
+        filename = img_path.name
+        stem = img_path.stem
+        meta = metas[i]
 
         # decide split
-        is_val = i in val_indices
-
-        if is_val:
+        if is_val[i]:
             img_dst = img_val / filename
             lbl_dst = lbl_val / (stem + ".txt")
         else:
             img_dst = img_train / filename
             lbl_dst = lbl_train / (stem + ".txt")
 
-        shutil.copy2(img_path, img_dst)
+        fast_copy(img_path, img_dst)
 
-        # write label file
-        with open(lbl_dst, "w", encoding="utf-8") as f_lbl:
-            for ann_item in page_annots:
-                entry = next(iter(ann_item.values()))
-                cls = entry["category"]
+        # collect all boxes of the page, then convert them in one go
+        cids = []
+        xywh = []
+        for entry in page_annots[i]:
+            cls = entry["category"]
 
-                if cls not in CLASS_MAP:
-                    print(f"[WARN] Unknown category '{cls}', skipping.")
-                    continue
+            if cls not in CLASS_MAP:
+                print(f"[WARN] Unknown category '{cls}', skipping.")
+                continue
 
-                cid = CLASS_MAP[cls]
-                bbox = entry["bbox"]
-                x, y, w, h = bbox["x"], bbox["y"], bbox["width"], bbox["height"]
+            cids.append(CLASS_MAP[cls])
+            bbox = entry["bbox"]
+            xywh.append((bbox["x"], bbox["y"], bbox["width"], bbox["height"]))
 
-                # original PDF → preprocessed coords
-                x_p, y_p, w_p, h_p = convert_orig_to_preprocessed(x, y, w, h, meta)
-                x_p, y_p, w_p, h_p = clip_bbox(x_p, y_p, w_p, h_p)
+        xywh = np.asarray(xywh, dtype=np.float64).reshape(-1, 4)
 
-                # → YOLO normalized
-                xc, yc, wn, hn = xywh_to_yolo(x_p, y_p, w_p, h_p)
+        # original PDF → preprocessed coords → clipped → YOLO normalized
+        yolo = orig_to_yolo_batch(xywh, meta)
 
-                f_lbl.write(f"{cid} {xc:.6f} {yc:.6f} {wn:.6f} {hn:.6f}\n")
+        # write label file in one go (empty file for pages without boxes)
+        write_yolo_labels(lbl_dst, cids, yolo)
 
     print(f"[YOLO] Dataset created at: {out_dir}")
 
@@ -1,13 +1,9 @@
 import os
 import sys
-import json
-import shutil
 import random
 from pathlib import Path
-from collections import Counter
 
 import numpy as np
-import cv2
 
 # -------------------------------------------------------------------
 # Allow imports from src/...
@@ -16,13 +12,10 @@ PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-# ---------- Unicode-safe image IO (works with Cyrillic) ----------
-def load_rgb_unicode(path: Path):
-    data = np.fromfile(str(path), dtype=np.uint8)
-    img = cv2.imdecode(data, cv2.IMREAD_COLOR)
-    if img is None:
-        raise FileNotFoundError(f"Cannot read image: {path}")
-    return img  # BGR is fine for shape
+from src.preprocessing.annotation_io import load_annotations
+from src.preprocessing.bbox_utils import page_to_yolo_batch
+from src.preprocessing.file_utils import disk_order, fast_copy, write_yolo_labels
+from src.preprocessing.resize_pad import image_size
 
 
 # ---------- Config ----------
@@ -49,8 +42,14 @@ def build_yolo_dataset_raw(
     random.seed(seed)
 
     # --- Load annotations ---
-    with open(annotations_json, "r", encoding="utf-8") as f:
-        annotations = json.load(f)
+    annotations = load_annotations(annotations_json)  # flat entries
+
+    # flat (pdf_key, page_key) -> page data index, built once
+    pages = {
+        (pdf_key, page_key): page_data
+        for pdf_key, doc_pages in annotations.items()
+        for page_key, page_data in doc_pages.items()
+    }
 
     raw_images_dir = Path(raw_images_dir)
     out_dir = Path(out_dir)
@@ -63,9 +62,21 @@ def build_yolo_dataset_raw(
     for d in [images_train, images_val, labels_train, labels_val]:
         d.mkdir(parents=True, exist_ok=True)
 
+    # names stay alphabetical (the split depends on record order), but
+    # files are touched in on-disk order
+    img_paths = sorted(raw_images_dir.glob("*.png"))
+
+    # image sizes only (PNG header, pixels are not decoded)
+    img_sizes = {}
+    for k in disk_order(img_paths):
+        try:
+            img_sizes[img_paths[k]] = image_size(img_paths[k])
+        except OSError as e:
+            img_sizes[img_paths[k]] = e
+
     # --- Build records: one per PNG page ---
     records = []
-    for img_path in sorted(raw_images_dir.glob("*.png")):
+    for img_path in img_paths:
         filename = img_path.name          # e.g. "АПЗ-2_page_001.png"
         stem = img_path.stem
 
@@ -79,23 +90,20 @@ def build_yolo_dataset_raw(
             print(f"[WARN] Cannot parse pdf/page from {filename}")
             continue
 
-        if pdf_key not in annotations or page_key not in annotations[pdf_key]:
+        page_data = pages.get((pdf_key, page_key))
+        if page_data is None:
             # no annotations for this page
             page_ann = []
             page_size = None
         else:
-            page_data = annotations[pdf_key][page_key]
             page_ann = page_data.get("annotations", [])
             page_size = page_data.get("page_size", None)
 
-        # load image to know its size
-        try:
-            img_bgr = load_rgb_unicode(img_path)
-        except FileNotFoundError as e:
-            print("[ERROR]", e)
+        size = img_sizes[img_path]
+        if isinstance(size, OSError):
+            print("[ERROR]", size)
             continue
-
-        h_img, w_img = img_bgr.shape[:2]
+        w_img, h_img = size
 
         if page_size is not None:
             pw = float(page_size["width"])
@@ -107,8 +115,7 @@ def build_yolo_dataset_raw(
 
         # compute which classes are present on this page
         classes_on_page = set()
-        for item in page_ann:
-            ann_id, entry = next(iter(item.items()))
+        for entry in page_ann:
             cls = entry["category"]
             if cls in CLASS_MAP:
                 classes_on_page.add(cls)
@@ -138,55 +145,55 @@ def build_yolo_dataset_raw(
     N = len(records)
     target_val_images = max(1, int(N * (1 - train_ratio)))
 
-    img_class_counts = Counter()
-    for rec in records:
-        for c in rec["classes"]:
-            img_class_counts[c] += 1
+    # class_mask[i, c] — page i contains class c at least once
+    class_names = list(CLASS_MAP)
+    class_mask = np.zeros((N, len(CLASS_MAP)), dtype=bool)
+    for i, rec in enumerate(records):
+        class_mask[i, [CLASS_MAP[c] for c in rec["classes"]]] = True
 
-    print("[STRAT-RAW] Image-level class counts:", img_class_counts)
+    img_class_counts = class_mask.sum(axis=0)
 
-    target_val_per_class = {}
-    for c, count in img_class_counts.items():
-        if count == 0:
-            continue
-        target = int(round(target_val_images * (count / N)))
-        target_val_per_class[c] = max(1, target)
+    print("[STRAT-RAW] Image-level class counts:", dict(zip(class_names, img_class_counts.tolist())))
 
-    print("[STRAT-RAW] Target val images per class:", target_val_per_class)
+    target_val_per_class = np.where(
+        img_class_counts > 0,
+        np.maximum(1, np.round(target_val_images * img_class_counts / N)),
+        0,
+    ).astype(int)
 
-    random.shuffle(records)
-    val_indices = set()
-    val_class_counts = Counter()
+    print("[STRAT-RAW] Target val images per class:", dict(zip(class_names, target_val_per_class.tolist())))
 
-    for i, rec in enumerate(records):
-        if len(val_indices) >= target_val_images:
-            break
-        if not rec["classes"]:
-            continue
+    # shuffled visiting order (same permutation as shuffling records in place)
+    order = list(range(N))
+    random.shuffle(order)
+    order = np.asarray(order)
 
-        needs_any = False
-        for c in rec["classes"]:
-            if c in target_val_per_class and val_class_counts[c] < target_val_per_class[c]:
-                needs_any = True
-                break
-        if needs_any:
-            val_indices.add(i)
-            for c in rec["classes"]:
-                val_class_counts[c] += 1
+    is_val = np.zeros(N, dtype=bool)
+    n_val = 0
+    val_class_counts = np.zeros(len(CLASS_MAP), dtype=int)
 
-    # fill remaining val slots randomly
-    for i, rec in enumerate(records):
-        if len(val_indices) >= target_val_images:
+    for i in order:
+        if n_val >= target_val_images:
             break
-        if i in val_indices:
-            continue
-        val_indices.add(i)
+        # take the page if it still helps some class target
+        row = class_mask[i]
+        if (row & (val_class_counts < target_val_per_class)).any():
+            is_val[i] = True
+            n_val += 1
+            val_class_counts += row
+
+    # fill remaining val slots randomly
+    remaining = order[~is_val[order]]
+    is_val[remaining[: max(0, target_val_images - n_val)]] = True
 
-    print("[STRAT-RAW] Final val size:", len(val_indices))
-    print("[STRAT-RAW] Class counts in val:", val_class_counts)
+    print("[STRAT-RAW] Final val size:", int(is_val.sum()))
+    print("[STRAT-RAW] Class counts in val:", dict(zip(class_names, val_class_counts.tolist())))
 
     # --- Write images + labels in YOLO format ---
-    for i, rec in enumerate(records):
+    # which split a page goes to is fixed by is_val; write in on-disk order
+    write_order = order[disk_order([records[i]["img_path"] for i in order])]
+    for i in write_order:
+        rec = records[i]
         img_path = rec["img_path"]
         filename = rec["filename"]
         stem = rec["stem"]
@@ -196,43 +203,31 @@ def build_yolo_dataset_raw(
         w_img = rec["w_img"]
         h_img = rec["h_img"]
 
-        is_val = i in val_indices
-
-        if is_val:
+        if is_val[i]:
             img_dst = images_val / filename
             lbl_dst = labels_val / f"{stem}.txt"
         else:
             img_dst = images_train / filename
             lbl_dst = labels_train / f"{stem}.txt"
 
-        shutil.copy2(img_path, img_dst)
-
-        # build label file
-        with lbl_dst.open("w", encoding="utf-8") as f_lbl:
-            for item in annotations_page:
-                ann_id, entry = next(iter(item.items()))
-                cls = entry["category"]
-                if cls not in CLASS_MAP:
-                    continue
-                cid = CLASS_MAP[cls]
-
-                bbox = entry["bbox"]
-                x, y = bbox["x"], bbox["y"]
-                w, h = bbox["width"], bbox["height"]
-
-                # scale from PDF/page → PNG
-                x_png = x * sx
-                y_png = y * sy
-                w_png = w * sx
-                h_png = h * sy
-
-                # YOLO normalized
-                xc = (x_png + w_png / 2) / w_img
-                yc = (y_png + h_png / 2) / h_img
-                wn = w_png / w_img
-                hn = h_png / h_img
-
-                f_lbl.write(f"{cid} {xc:.6f} {yc:.6f} {wn:.6f} {hn:.6f}\n")
+        fast_copy(img_path, img_dst)
+
+        # build label file: all boxes of the page at once
+        entries = [e for e in annotations_page if e["category"] in CLASS_MAP]
+        cids = np.fromiter((CLASS_MAP[e["category"]] for e in entries), np.int64, len(entries))
+        xywh = np.array(
+            [
+                (e["bbox"]["x"], e["bbox"]["y"], e["bbox"]["width"], e["bbox"]["height"])
+                for e in entries
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+
+        # scale from PDF/page → PNG, then YOLO normalized
+        yolo = page_to_yolo_batch(xywh, sx, sy, w_img, h_img)
+
+        # one write per page (empty file for pages without boxes)
+        write_yolo_labels(lbl_dst, cids.tolist(), yolo)
 
     print(f"[YOLO_RAW] Dataset created at: {out_dir}")
 
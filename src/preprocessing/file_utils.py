@@ -0,0 +1,111 @@
+# src/preprocessing/file_utils.py
+
+import os
+import shutil
+from pathlib import Path
+
+# ioctl(FICLONE): share all extents of src with dst on CoW filesystems
+FICLONE = 0x40049409
+
+
+def _try_link(src: Path, dst: Path) -> bool:
+    """Hard link dst → src (same device only). No data is written at all."""
+    try:
+        if os.stat(src).st_dev != os.stat(dst.parent).st_dev:
+            return False
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+def _try_reflink(src: Path, dst: Path) -> bool:
+    """Reflink clone via FICLONE (Btrfs/XFS/...); Linux only."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with src.open("rb") as f_src, dst.open("wb") as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _try_copy_file_range(src: Path, dst: Path) -> bool:
+    """In-kernel copy via os.copy_file_range (Linux >= 4.5)."""
+    if not hasattr(os, "copy_file_range"):
+        return False
+    try:
+        with src.open("rb") as f_src, dst.open("wb") as f_dst:
+            remaining = os.fstat(f_src.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(f_src.fileno(), f_dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        return remaining == 0
+    except OSError:
+        return False  # e.g. cross-device on old kernels → regular copy
+
+
+def fast_copy(src, dst, link: bool = False):
+    """
+    Put the contents of src at dst as cheaply as the platform allows.
+
+    Tried in order:
+      1. os.link, only with link=True: hard link, O(1) and no extra disk
+         space, but dst and src are then the same inode — any later
+         open(dst, "wb") (a rerun's save_rgb, ndarray.tofile, ...) truncates
+         and rewrites src too. Only opt in when neither side is ever
+         written to in place;
+      2. FICLONE reflink on CoW filesystems (Btrfs/XFS): shares extents
+         copy-on-write, so writes to one side never reach the other;
+      3. os.copy_file_range: the copy stays in the kernel;
+      4. shutil.copyfile.
+    Unlike shutil.copy2, metadata (mtime, permissions) is not copied —
+    datasets don't need it.
+
+    An existing dst is removed first: it may be a hard link to src from a
+    previous run, and opening it for writing would truncate src as well.
+    """
+    src = Path(src)
+    dst = Path(dst)
+
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+
+    if link and _try_link(src, dst):
+        return
+    if _try_reflink(src, dst) or _try_copy_file_range(src, dst):
+        return
+
+    shutil.copyfile(src, dst)
+
+
+def write_yolo_labels(path, cids, boxes):
+    """
+    Write one YOLO label file ("cid xc yc w h" per line, 6 decimals).
+
+    All lines are formatted in memory and written with a single
+    write_bytes call; pages without boxes get an empty file.
+    """
+    lines = [
+        "%d %.6f %.6f %.6f %.6f\n" % (cid, xc, yc, w, h)
+        for cid, (xc, yc, w, h) in zip(cids, boxes.tolist())
+    ]
+    Path(path).write_bytes("".join(lines).encode("ascii"))
+
+
+def disk_order(paths) -> list:
+    """
+    Indices that visit paths in (approximate) on-disk order: sorted by
+    inode number on POSIX, where inodes of files written together are
+    allocated close to each other; unchanged order elsewhere.
+    Cuts random seeks on HDDs, costs one stat() per file.
+    """
+    if os.name == "nt":
+        return list(range(len(paths)))
+    inodes = [os.stat(p).st_ino for p in paths]
+    return sorted(range(len(paths)), key=inodes.__getitem__)
@@ -1,15 +1,81 @@
 # src/preprocessing/pdf_to_images.py
 
+import os
+import cv2
 import fitz
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import List
 
+# pages handed to a worker per IPC round-trip
+RENDER_CHUNKSIZE = 4
+
+# zlib level for PNG pages: 1 is ~3x faster to encode than PyMuPDF's
+# default, for ~20% bigger files
+PNG_COMPRESSION = 1
+
+# per-worker cache of the last opened PDF: consecutive pages of one PDF
+# (which is how chunks arrive) reuse the parsed document
+_open_doc = (None, None)
+
+
+def _page_path(pdf_path: Path, out_dir: Path, page_index: int, img_format: str) -> Path:
+    img_name = f"{pdf_path.stem}_page_{page_index+1:03d}.{img_format}"
+    return out_dir / img_name
+
+
+def _save_page(page, mat, img_path: Path, png_compression: int = PNG_COMPRESSION) -> None:
+    pix = page.get_pixmap(matrix=mat, alpha=False, colorspace=fitz.csRGB)
+
+    if img_path.suffix.lower() != ".png":
+        pix.save(img_path.as_posix())
+        return
+
+    # encode with libpng at a low zlib level instead of pix.save
+    rgb = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+    ok, buf = cv2.imencode(
+        ".png", cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR),
+        [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    )
+    if not ok:
+        raise RuntimeError(f"Failed to encode page: {img_path}")
+    buf.tofile(str(img_path))  # Unicode-safe write
+
+
+def _render_page(
+    pdf_path: Path,
+    page_index: int,
+    dpi: int,
+    out_dir: Path,
+    img_format: str,
+    png_compression: int = PNG_COMPRESSION
+) -> Path:
+    """
+    Render one page to out_dir (runs in a worker process).
+
+    fitz.Document handles can't be shared between processes, so the PDF is
+    opened inside the worker; the last one stays open for the next page.
+    """
+    global _open_doc
+    if _open_doc[0] != pdf_path:
+        if _open_doc[1] is not None:
+            _open_doc[1].close()
+        _open_doc = (pdf_path, fitz.open(pdf_path))
+    doc = _open_doc[1]
+
+    zoom = dpi / 72
+    img_path = _page_path(pdf_path, out_dir, page_index, img_format)
+    _save_page(doc[page_index], fitz.Matrix(zoom, zoom), img_path, png_compression)
+    return img_path
+
 
 def pdf_to_images(
     pdf_path: str,
     out_dir: str,
     dpi: int = 300,
-    img_format: str = "png"
+    img_format: str = "png",
+    png_compression: int = PNG_COMPRESSION
 ) -> List[Path]:
     """
     Convert a PDF into page images.
@@ -19,6 +85,7 @@ def pdf_to_images(
         out_dir: directory where page images will be saved.
         dpi: resolution for rendering.
         img_format: image format ('png' or 'jpg').
+        png_compression: zlib level (0-9) for PNG output.
 
     Returns:
         List of paths to the saved page images.
@@ -30,15 +97,14 @@ def pdf_to_images(
     doc = fitz.open(pdf_path)
     page_paths = []
 
+    zoom = dpi / 72
+    mat = fitz.Matrix(zoom, zoom)
+
     for page_index in range(len(doc)):
         page = doc[page_index]
-        zoom = dpi / 72
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
 
-        img_name = f"{pdf_path.stem}_page_{page_index+1:03d}.{img_format}"
-        img_path = out_dir / img_name
-        pix.save(img_path.as_posix())
+        img_path = _page_path(pdf_path, out_dir, page_index, img_format)
+        _save_page(page, mat, img_path, png_compression)
 
         page_paths.append(img_path)
 
@@ -50,24 +116,58 @@ def convert_all_pdfs(
     pdf_dir: str = "data/testing",
     out_dir: str = "data/pngs_processed_testing",
     dpi: int = 300,
-    img_format: str = "png"
+    img_format: str = "png",
+    workers: int = None,
+    png_compression: int = PNG_COMPRESSION
 ):
     """
     Convert all PDFs in pdf_dir to images.
+
+    Pages of all PDFs are rendered in parallel, one process per core
+    (workers=None); with a single core the PDFs are converted sequentially.
     """
     pdf_dir = Path(pdf_dir)
+    out_dir = Path(out_dir)
     pdf_files = sorted(pdf_dir.glob("*.pdf"))
-    all_page_paths = []
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1:
+        all_page_paths = []
+        for pdf_file in pdf_files:
+            print(f"[PDF2IMG] Processing {pdf_file.name}")
+            page_paths = pdf_to_images(
+                pdf_path=pdf_file,
+                out_dir=out_dir,
+                dpi=dpi,
+                img_format=img_format,
+                png_compression=png_compression
+            )
+            all_page_paths.extend(page_paths)
+
+        print(f"[PDF2IMG] Done. Total pages: {len(all_page_paths)}")
+        return all_page_paths
+
+    out_dir.mkdir(parents=True, exist_ok=True)
 
+    # one task per (pdf, page), in document order
+    tasks = []
     for pdf_file in pdf_files:
-        print(f"[PDF2IMG] Processing {pdf_file.name}")
-        page_paths = pdf_to_images(
-            pdf_path=pdf_file,
-            out_dir=out_dir,
-            dpi=dpi,
-            img_format=img_format
-        )
-        all_page_paths.extend(page_paths)
+        with fitz.open(pdf_file) as doc:
+            n_pages = len(doc)
+        print(f"[PDF2IMG] Queued {pdf_file.name} ({n_pages} pages)")
+        tasks.extend((pdf_file, page_index) for page_index in range(n_pages))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        all_page_paths = list(pool.map(
+            _render_page,
+            [pdf for pdf, _ in tasks],
+            [page for _, page in tasks],
+            [dpi] * len(tasks),
+            [out_dir] * len(tasks),
+            [img_format] * len(tasks),
+            [png_compression] * len(tasks),
+            chunksize=RENDER_CHUNKSIZE,
+        ))
 
     print(f"[PDF2IMG] Done. Total pages: {len(all_page_paths)}")
     return all_page_paths
@@ -1,17 +1,87 @@
 # src/preprocessing/preprocess_page.py
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import json
+import multiprocessing
+import os
+import cv2
+import numpy as np
 from tqdm import tqdm
 
-from .resize_pad import load_rgb, resize_and_pad, save_rgb
+from .resize_pad import iter_rgb, load_rgb, resize_and_pad, save_rgb
+
+# pages handed to a worker per IPC round-trip
+PREPROCESS_CHUNKSIZE = 8
+
+# store="npy": all pages in one (N, T, T, 3) uint8 array in dst_dir
+PAGES_NPY = "pages_u8.npy"
+
+# per-worker output canvas / opened pages memmap (see _preprocess_one)
+_canvas = None
+_pages = None
+
+
+def _preprocess_image(img_path: Path, img: np.ndarray, dst_dir: Path,
+                      target_size: int, canvas: np.ndarray,
+                      save: bool = True) -> dict:
+    """
+    Resize + pad one page into canvas, save it to dst_dir as an image
+    (save=False: canvas is a row of the pages memmap), return its metadata.
+    """
+    resized_padded, scale, pad_left, pad_top = resize_and_pad(
+        img, target_size=target_size, dst=canvas
+    )
+
+    if save:
+        out_path = dst_dir / img_path.name  # keep same filename
+        save_rgb(out_path, resized_padded)
+
+    return {
+        "scale": scale,
+        "pad_left": pad_left,
+        "pad_top": pad_top,
+        "orig_width": img.shape[1],
+        "orig_height": img.shape[0],
+        "target_size": target_size,
+    }
+
+
+def _init_worker():
+    # one page per process already uses every core; don't let each
+    # worker's OpenCV spin up cpu_count threads on top of that
+    cv2.setNumThreads(1)
+
+
+def _preprocess_one(img_path: Path, dst_dir: Path, target_size: int, index: int = None):
+    """
+    Worker task: load + preprocess one page → (filename, metadata).
+    With index set, the page goes into row `index` of dst_dir/PAGES_NPY.
+    """
+    global _canvas, _pages
+    img = load_rgb(img_path)
+
+    if index is not None:
+        if _pages is None:
+            _pages = np.load(dst_dir / PAGES_NPY, mmap_mode="r+")
+        meta = _preprocess_image(img_path, img, dst_dir, target_size, _pages[index], save=False)
+        meta["index"] = index
+        return img_path.name, meta
+
+    if _canvas is None or _canvas.shape[0] != target_size:
+        _canvas = np.empty((target_size, target_size, 3), dtype=np.uint8)
+
+    return img_path.name, _preprocess_image(img_path, img, dst_dir, target_size, _canvas)
 
 
 def preprocess_all_pages(
     src_dir: str = "data/pngs_processed",
     dst_dir: str = "data/preprocessed",
     target_size: int = 1024,
-    split: str = "train"
+    split: str = "train",
+    device: str = "cpu",
+    workers: int = None,
+    store: str = "png"
 ):
     """
     Preprocess all page images in src_dir:
@@ -25,6 +95,14 @@ def preprocess_all_pages(
         dst_dir: base directory for preprocessed pages
         target_size: output image size (square)
         split: "train", "val", or "test"
+        device: "cpu", or "cuda" to decode/resize in GPU batches
+                (see preprocess_page_gpu)
+        workers: CPU processes (default: one per core; 1 = in-process)
+        store: "png" — one image per page (what the YOLO dataset builders
+               copy); "npy" — all pages in one uint8 array
+               dst_dir/<split>/pages_u8.npy, written in place with no PNG
+               encode; metadata gets the page's row "index". Load it with
+               np.load(path, mmap_mode="r").
     """
     src_dir = Path(src_dir)
     dst_dir = Path(dst_dir) / split
@@ -33,28 +111,80 @@ def preprocess_all_pages(
 
     image_paths = sorted(src_dir.glob("*.png"))  # change if jpg
 
+    if store not in ("png", "npy"):
+        raise ValueError(f"Unknown store: {store!r}")
+
+    if device == "cuda":
+        if store != "png":
+            raise ValueError("store='npy' is only supported on the CPU path")
+        from .preprocess_page_gpu import preprocess_pages_gpu
+
+        metadata = preprocess_pages_gpu(image_paths, dst_dir, target_size=target_size)
+        _save_metadata(metadata, meta_dir, split)
+        return
+
+    workers = workers or os.cpu_count() or 1
     metadata = {}
+    n = len(image_paths)
 
-    for img_path in tqdm(image_paths, desc=f"Preprocessing ({split})"):
-        img = load_rgb(img_path)
-        resized_padded, scale, pad_left, pad_top = resize_and_pad(
-            img, target_size=target_size
+    pages = None
+    if store == "npy":
+        # preallocated on disk; every page is resized straight into its row
+        dst_dir.mkdir(parents=True, exist_ok=True)
+        pages = np.lib.format.open_memmap(
+            dst_dir / PAGES_NPY, mode="w+", dtype=np.uint8,
+            shape=(n, target_size, target_size, 3),
         )
+        if workers > 1:
+            pages.flush()
+            del pages  # workers open their own r+ maps of the file
 
-        out_name = img_path.name  # keep same filename
-        out_path = dst_dir / out_name
-        save_rgb(out_path, resized_padded)
+    if workers > 1:
+        # pages are independent: one task per page, results come back in order
+        indices = list(range(n)) if store == "npy" else [None] * n
+        # spawn, not fork: a forked child inherits libvips' (pyvips) threads
+        # and locks from the parent in whatever state they were and can hang
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        ) as ex:
+            results = ex.map(
+                _preprocess_one,
+                image_paths, [dst_dir] * n, [target_size] * n, indices,
+                chunksize=PREPROCESS_CHUNKSIZE,
+            )
+            for name, meta in tqdm(results, total=n, desc=f"Preprocessing ({split})"):
+                metadata[name] = meta
+
+        _save_metadata(metadata, meta_dir, split)
+        return
 
-        metadata[out_name] = {
-            "scale": scale,
-            "pad_left": pad_left,
-            "pad_top": pad_top,
-            "orig_width": img.shape[1],
-            "orig_height": img.shape[0],
-            "target_size": target_size,
-        }
+    # file reads are prefetched in threads, decoding happens here
+    images = iter_rgb(image_paths)
 
-    # Save metadata as JSON
+    # one output canvas for all pages: each page is encoded by save_rgb
+    # before the next resize overwrites it
+    canvas = np.empty((target_size, target_size, 3), dtype=np.uint8)
+
+    for i, (img_path, img) in enumerate(tqdm(
+        zip(image_paths, images), total=n, desc=f"Preprocessing ({split})"
+    )):
+        if pages is not None:
+            meta = _preprocess_image(img_path, img, dst_dir, target_size, pages[i], save=False)
+            meta["index"] = i
+        else:
+            meta = _preprocess_image(img_path, img, dst_dir, target_size, canvas)
+        metadata[img_path.name] = meta
+
+    if pages is not None:
+        pages.flush()
+
+    _save_metadata(metadata, meta_dir, split)
+
+
+def _save_metadata(metadata: dict, meta_dir: Path, split: str):
+    """Save metadata as JSON."""
     meta_path = meta_dir / f"preprocess_meta_{split}.json"
     with meta_path.open("w", encoding="utf-8") as f:
         json.dump(metadata, f, ensure_ascii=False, indent=2)
@@ -63,5 +193,12 @@ def preprocess_all_pages(
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", choices=["cpu", "cuda"], default="cpu")
+    parser.add_argument("--store", choices=["png", "npy"], default="png")
+    args = parser.parse_args()
+
     # For hackathon: at first you may treat everything as train, then later split.
-    preprocess_all_pages(split="train")
+    preprocess_all_pages(split="train", device=args.device, store=args.store)